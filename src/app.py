@@ -1,21 +1,23 @@
 """Streamlit dashboard for O2C Email Agent."""
 
-import json
-import os
 import sys
+from collections.abc import Iterator
 from datetime import datetime
 from pathlib import Path
 
+import orjson
 import streamlit as st
-from dotenv import load_dotenv
 
 # Add src to path for imports
 sys.path.insert(0, str(Path(__file__).parent))
 from email_generator import generate_draft_email
+from keys import get_api_keys
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 CASES_FILE = BASE_DIR / "outputs" / "processed_cases.json"
-SENT_FILE = BASE_DIR / "outputs" / "sent_emails.json"
+SENT_FILE = BASE_DIR / "outputs" / "sent_emails.jsonl"
+
+QUEUES = ("Cash Application", "Disputes", "AR Support", "Manual Review")
 
 QUEUE_EMAILS = {
     "Cash Application": "cashapplication@email.com",
@@ -24,63 +26,98 @@ QUEUE_EMAILS = {
 }
 
 
-def load_api_keys() -> list[str]:
-    load_dotenv(BASE_DIR / ".env")
-    keys = []
-    for i in range(1, 6):
-        key = os.getenv(f"GEMINI_API_KEY_{i}")
-        if key:
-            keys.append(key)
-    return keys
+def cases_mtime() -> float:
+    return CASES_FILE.stat().st_mtime if CASES_FILE.exists() else 0.0
 
 
-def load_cases() -> list[dict]:
+@st.cache_data(show_spinner=False)
+def load_cases(mtime: float) -> list[dict]:
+    """Parse the cases file; `mtime` is the cache key so edits are picked up."""
     if not CASES_FILE.exists():
         return []
-    with open(CASES_FILE, encoding="utf-8") as f:
-        return json.load(f)
+    with open(CASES_FILE, "rb") as f:
+        return orjson.loads(f.read())
+
+
+@st.cache_data(show_spinner=False)
+def cases_by_queue(mtime: float) -> dict[str, list[dict]]:
+    """Bucket cases by queue once per file version; unknown queues go to Manual Review."""
+    by_queue = {q: [] for q in QUEUES}
+    for c in load_cases(mtime):
+        by_queue.get(c.get("queue"), by_queue["Manual Review"]).append(c)
+    return by_queue
+
+
+def session_cases_by_queue(mtime: float) -> dict[str, list[dict]]:
+    """Keep this session's queue buckets in session_state so reruns reuse the same objects.
+
+    st.cache_data hands back a fresh copy on every call, which means unpickling
+    every case on each rerun.
+    """
+    cached = st.session_state.get("cases_by_queue")
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, cases_by_queue(mtime))
+        st.session_state["cases_by_queue"] = cached
+    return cached[1]
+
+
+@st.cache_data(show_spinner=False)
+def queue_labels(queue_name: str, mtime: float) -> list[str]:
+    """Selectbox labels for one queue, built once per file version."""
+    labels = []
+    for c in cases_by_queue(mtime)[queue_name]:
+        inv = ", ".join(c.get("invoice_references", [])) or "N/A"
+        customer = c.get("customer_name", "Unknown")
+        subject = c.get("subject", "")
+        labels.append(f"{inv} \u2014 {customer} \u2014 {subject}")
+    return labels
 
 
 def log_sent_email(case: dict, draft: dict, recipient: str):
-    sent = []
-    if SENT_FILE.exists():
-        with open(SENT_FILE, encoding="utf-8") as f:
-            sent = json.load(f)
-    sent.append({
+    """Append one sent email to the JSON Lines log."""
+    entry = {
         "email_id": case["email_id"],
         "to": recipient,
         "subject": draft["subject"],
         "body": draft["body"],
         "sent_at": datetime.now().isoformat(),
-    })
-    with open(SENT_FILE, "w", encoding="utf-8") as f:
-        json.dump(sent, f, indent=2)
+    }
+    SENT_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(SENT_FILE, "ab") as f:
+        f.write(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE))
 
 
-def render_queue_tab(cases: list[dict], queue_name: str, api_keys: list[str]):
-    """Render a single queue tab with case selector and details."""
-    queue_cases = [c for c in cases if c.get("queue") == queue_name]
+def read_sent() -> Iterator[dict]:
+    """Lazily yield logged sent emails, oldest first."""
+    if not SENT_FILE.exists():
+        return
+    with open(SENT_FILE, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
 
+
+def render_queue_tab(queue_cases: list[dict], queue_name: str, mtime: float, api_keys: tuple[str, ...]):
+    """Render a single queue tab with case selector and details."""
     if not queue_cases:
         st.info(f"No cases in {queue_name} queue.")
         return
 
     st.caption(f"{len(queue_cases)} cases")
 
-    # Build display labels for selectbox
-    labels = []
-    for c in queue_cases:
-        inv = ", ".join(c.get("invoice_references", [])) or "N/A"
-        customer = c.get("customer_name", "Unknown")
-        subject = c.get("subject", "")
-        labels.append(f"{inv} \u2014 {customer} \u2014 {subject}")
+    labels = queue_labels(queue_name, mtime)
 
+    # Streamlit drops widget state while another queue is shown, so the selection
+    # and edited drafts are also kept under plain session_state keys
+    selected_key = f"selected_{queue_name}"
     selected_idx = st.selectbox(
         "Select a case:",
         range(len(labels)),
+        index=min(st.session_state.get(selected_key, 0), len(labels) - 1),
         format_func=lambda i: labels[i],
         key=f"select_{queue_name}",
     )
+    st.session_state[selected_key] = selected_idx
 
     case = queue_cases[selected_idx]
 
@@ -107,11 +144,16 @@ def render_queue_tab(cases: list[dict], queue_name: str, api_keys: list[str]):
     # Draft email generation
     st.markdown("---")
     draft_key = f"draft_{queue_name}_{selected_idx}"
+    edited_key = f"edited_{queue_name}_{selected_idx}"
+    body_key = f"body_{queue_name}_{selected_idx}"
 
     if st.button("Generate Draft Email", key=f"gen_{queue_name}_{selected_idx}"):
         with st.spinner("Generating draft..."):
             draft = generate_draft_email(case, api_keys)
             st.session_state[draft_key] = draft
+            # A fresh draft replaces any edits to the previous one
+            st.session_state.pop(edited_key, None)
+            st.session_state.pop(body_key, None)
 
     if draft_key in st.session_state:
         draft = st.session_state[draft_key]
@@ -121,10 +163,11 @@ def render_queue_tab(cases: list[dict], queue_name: str, api_keys: list[str]):
 
         edited_body = st.text_area(
             "Email Body:",
-            value=draft["body"],
+            value=st.session_state.get(edited_key, draft["body"]),
             height=200,
-            key=f"body_{queue_name}_{selected_idx}",
+            key=body_key,
         )
+        st.session_state[edited_key] = edited_body
 
         if st.button("Send Email", key=f"send_{queue_name}_{selected_idx}"):
             final_draft = {"subject": draft["subject"], "body": edited_body}
@@ -136,29 +179,23 @@ def main():
     st.set_page_config(page_title="O2C Email Agent", layout="wide")
     st.title("O2C Email Agent \u2014 Dashboard")
 
-    cases = load_cases()
-    if not cases:
+    mtime = cases_mtime()
+    by_queue = session_cases_by_queue(mtime)
+    if not any(by_queue.values()):
         st.error("No processed cases found. Run `python src/classify.py` first to process emails.")
         return
 
-    api_keys = load_api_keys()
+    api_keys = get_api_keys()
     if not api_keys:
         st.warning("No API keys found in .env. Draft generation will not work.")
 
-    manual_review_count = sum(1 for c in cases if c.get("queue") == "Manual Review")
+    manual_review_count = len(by_queue["Manual Review"])
     if manual_review_count:
         st.warning(f"⚠️ {manual_review_count} emails need manual review")
 
-    tab1, tab2, tab3, tab4 = st.tabs(["Cash Application", "Disputes", "AR Support", "Manual Review"])
-
-    with tab1:
-        render_queue_tab(cases, "Cash Application", api_keys)
-    with tab2:
-        render_queue_tab(cases, "Disputes", api_keys)
-    with tab3:
-        render_queue_tab(cases, "AR Support", api_keys)
-    with tab4:
-        render_queue_tab(cases, "Manual Review", api_keys)
+    # Only the selected queue renders on each rerun; drafts persist in session_state
+    active = st.radio("Queue", QUEUES, horizontal=True, key="active_tab")
+    render_queue_tab(by_queue[active], active, mtime, api_keys)
 
 
 if __name__ == "__main__":
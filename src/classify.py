@@ -1,31 +1,62 @@
 """Batch email classifier — run once before launching the dashboard."""
 
-import json
+import asyncio
 import os
+import random
 import sys
 import time
 from collections import Counter
+from collections.abc import Iterator
+from itertools import islice
 from pathlib import Path
+from string import Formatter
 
-from dotenv import load_dotenv
+import httpx
+import ijson
+import orjson
 from google import genai
 
+from keys import get_api_keys
+from parsing import parse_json
+
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_FILE = BASE_DIR / "data" / "Sample Emails.json"
 OUTPUT_FILE = BASE_DIR / "outputs" / "processed_cases.json"
+# One case per line, appended as each email finishes; removed once OUTPUT_FILE is written
+PROGRESS_FILE = BASE_DIR / "outputs" / "processed_cases.jsonl"
 
 MODELS = ["gemini-2.5-flash-lite", "gemini-2.5-flash", "gemini-2.0-flash"]
 
-CLASSIFY_PROMPT = """You are an Order-to-Cash email classification agent.
+# Free tier requests-per-minute limit, applied to each key separately
+RPM_PER_KEY = 15
 
-Analyze this email and respond with ONLY valid JSON, no markdown, no backticks:
+# A rate-limited key sits out BACKOFF_BASE * 2**n seconds (capped) plus jitter,
+# where n counts its consecutive 429/503 responses
+BACKOFF_BASE = 2
+BACKOFF_CAP = 60
+BACKOFF_JITTER = 1.0
 
-From: {sender}
-Subject: {subject}
-Body: {body}
-Received: {received_at}
+# Passes over every key/model before a batch is given up on: one try, one retry
+MAX_ROUNDS = 2
+
+# Connection pool shared by every key's client (the API key travels as a request header)
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+# In milliseconds. The SDK passes this on every request, overriding the httpx client's own timeout
+HTTP_TIMEOUT_MS = 60_000
+
+# Emails sent to the model per request
+BATCH_SIZE = 10
+# Output budget per email, capped at the smallest limit among MODELS (gemini-2.0-flash)
+TOKENS_PER_EMAIL = 1024
+MAX_OUTPUT_TOKENS = 8192
 
-Respond in this exact JSON format:
+CLASSIFY_PROMPT = """You are an Order-to-Cash email classification agent.
+
+Analyze each of the {count} numbered emails below and respond with ONLY a valid JSON array, no markdown, no backticks.
+The array must contain exactly {count} objects, one per email, in the same order as the emails.
+
+{emails}
+Each object in the array must use this exact JSON format:
 {{
     "category": "Payment Claim" OR "Dispute" OR "General AR Request",
     "queue": "Cash Application" OR "Disputes" OR "AR Support",
@@ -43,153 +74,342 @@ Classification rules:
 - "General AR Request" -> invoice copy request, statement request, payment confirmation request, proof of delivery request -> queue: "AR Support"
 """
 
+EMAIL_TEMPLATE = """Email {number}:
+From: {sender}
+Subject: {subject}
+Body: {body}
+Received: {received_at}
+"""
 
-def load_api_keys() -> list[str]:
-    load_dotenv(BASE_DIR / ".env")
-    keys = []
-    for i in range(1, 6):
-        key = os.getenv(f"GEMINI_API_KEY_{i}")
-        if key:
-            keys.append(key)
-    if not keys:
-        print("Error: No GEMINI_API_KEY_* found in .env")
-        sys.exit(1)
-    return keys
 
+class KeyLimiter:
+    """Spaces out requests on one API key and benches it after rate-limit errors."""
 
-def load_emails() -> list[dict]:
-    with open(DATA_FILE, encoding="utf-8") as f:
-        return json.load(f)["emails"]
+    def __init__(self, rpm: int):
+        self.min_interval = 60 / rpm
+        self.next_ok = 0.0
+        self.cooldown_until = 0.0
+        self.failures = 0
 
+    def cooling_down(self) -> bool:
+        return self.cooldown_until > time.monotonic()
 
-def parse_json(raw: str) -> dict:
-    text = raw.strip()
-    if text.startswith("```"):
-        text = text.split("\n", 1)[1]
-        text = text.rsplit("```", 1)[0].strip()
-    return json.loads(text)
+    def backoff(self):
+        """Bench this key after a 429/503, doubling the delay on each consecutive one."""
+        delay = min(BACKOFF_BASE * 2 ** self.failures, BACKOFF_CAP) + random.uniform(0, BACKOFF_JITTER)
+        self.failures += 1
+        self.cooldown_until = time.monotonic() + delay
 
+    def succeeded(self):
+        self.failures = 0
 
-def classify_email(email: dict, clients: list, key_index: int) -> dict | None:
-    """Classify a single email, rotating through keys and models on failure."""
-    prompt = CLASSIFY_PROMPT.format(
-        sender=email["from"],
-        subject=email["subject"],
-        body=email["body"],
-        received_at=email["receivedAt"],
-    )
+    async def wait(self):
+        """Sleep only if this key's next request slot hasn't opened yet."""
+        # No await between reading and reserving the slot, so this is atomic on the event loop
+        now = time.monotonic()
+        wait = self.next_ok - now
+        self.next_ok = max(now, self.next_ok) + self.min_interval
+        if wait > 0:
+            await asyncio.sleep(wait)
 
-    num_keys = len(clients)
 
-    for model in MODELS:
-        for offset in range(num_keys):
-            ki = (key_index + offset) % num_keys
-            client = clients[ki]
-            try:
-                response = client.models.generate_content(
-                    model=model,
-                    contents=prompt,
-                    config=genai.types.GenerateContentConfig(max_output_tokens=1024),
-                )
-                return parse_json(response.text)
-            except json.JSONDecodeError:
-                print(f"\n    JSON parse error on key{ki+1}/{model}", end=" ", flush=True)
-                continue
-            except Exception as e:
-                err = str(e)
-                if "429" in err or "503" in err:
-                    print(f"\n    Rate limited key{ki+1}/{model}", end=" ", flush=True)
-                    continue
-                raise
-
-    # All keys/models failed once — wait and try one more time
-    print("\n    All keys busy, waiting 15s...", end=" ", flush=True)
-    time.sleep(15)
-    for model in MODELS:
-        for offset in range(num_keys):
-            ki = (key_index + offset) % num_keys
-            client = clients[ki]
-            try:
-                response = client.models.generate_content(
-                    model=model,
-                    contents=prompt,
-                    config=genai.types.GenerateContentConfig(max_output_tokens=1024),
-                )
-                return parse_json(response.text)
-            except Exception:
-                continue
+def iter_emails() -> Iterator[dict]:
+    """Stream emails from the dataset one at a time instead of loading the whole file."""
+    with open(DATA_FILE, "rb") as f:
+        yield from ijson.items(f, "emails.item", use_float=True)
 
-    return None
 
+def _split_template(template: str) -> list[str | tuple[str]]:
+    """Split a str.format template into literal chunks and (field,) placeholders.
 
-def main():
-    keys = load_api_keys()
-    print(f"Loaded {len(keys)} API keys.")
+    Escaped {{ }} braces come back as plain literal braces.
+    """
+    parts = []
+    for literal, field, _, _ in Formatter().parse(template):
+        if literal:
+            parts.append(literal)
+        if field is not None:
+            parts.append((field,))
+    return parts
 
-    clients = [genai.Client(api_key=k) for k in keys]
 
-    emails = load_emails()
-    print(f"Found {len(emails)} emails to process.\n")
+def _render(parts: list[str | tuple[str]], values: dict) -> str:
+    return "".join(p if isinstance(p, str) else str(values[p[0]]) for p in parts)
 
-    results = []
-    errors = 0
 
-    for i, email in enumerate(emails):
-        ki = i % len(clients)
-        print(f"Processing email {i+1}/{len(emails)} (using key {ki+1})...", end=" ", flush=True)
+# Parsed once at import so each prompt is a single join instead of a template scan
+_PROMPT_PARTS = _split_template(CLASSIFY_PROMPT)
+_EMAIL_PARTS = _split_template(EMAIL_TEMPLATE)
 
-        try:
-            data = classify_email(email, clients, ki)
-            if data is None:
-                raise RuntimeError("All keys exhausted")
 
-            results.append({
-                "email_id": email["id"],
-                "received_at": email["receivedAt"],
-                "from": email["from"],
+def build_prompt(emails: list[dict]) -> str:
+    return _render(_PROMPT_PARTS, {
+        "count": len(emails),
+        "emails": "\n".join(
+            _render(_EMAIL_PARTS, {
+                "number": n,
+                "sender": email["from"],
                 "subject": email["subject"],
                 "body": email["body"],
-                **data,
-            })
-            print(f"-> {data['category']} -> {data['queue']}")
-        except Exception as e:
-            errors += 1
-            print(f"ERROR: {e}")
-            results.append({
-                "email_id": email["id"],
                 "received_at": email["receivedAt"],
-                "from": email["from"],
-                "subject": email["subject"],
-                "body": email["body"],
-                "category": "Error",
-                "queue": "Manual Review",
-                "customer_name": "",
-                "invoice_references": [],
-                "amounts": [],
-                "dates": [],
-                "dispute_reason": "",
-                "next_action": f"Manual review needed: {str(e)[:100]}",
             })
+            for n, email in enumerate(emails, 1)
+        ),
+    })
+
+
+class BatchMismatchError(Exception):
+    """The model answered, but not with one result object per email."""
+
+
+def parse_batch(raw: str, count: int) -> list[dict]:
+    """Parse a batch response, rejecting it unless it has one object per email."""
+    try:
+        data = parse_json(raw)
+    except ValueError as e:
+        if count > 1:
+            # Usually a reply cut off at the output token cap, which a retry won't fix
+            raise BatchMismatchError(f"invalid JSON: {e}") from e
+        raise
+    if count == 1 and isinstance(data, dict):
+        # Single-email prompts often get a bare object back instead of a one-item array
+        data = [data]
+    if not isinstance(data, list) or not all(isinstance(d, dict) for d in data):
+        raise BatchMismatchError("expected a JSON array of objects")
+    if len(data) != count:
+        raise BatchMismatchError(f"expected {count} results, got {len(data)}")
+    return data
+
+
+async def classify_batch(
+    emails: list[dict], clients: list, limiters: list[KeyLimiter], key_index: int
+) -> tuple[list[dict], int] | None:
+    """Classify several emails in one request, rotating through keys and models on failure.
+
+    Returns the results along with the index of the key that answered.
+    """
+    prompt = build_prompt(emails)
+    label = emails[0]["id"] if len(emails) == 1 else f"{emails[0]['id']}..{emails[-1]['id']}"
+    config = genai.types.GenerateContentConfig(
+        max_output_tokens=min(TOKENS_PER_EMAIL * len(emails), MAX_OUTPUT_TOKENS),
+    )
+
+    num_keys = len(clients)
+    # Set during each pass when a key was benched or rate limited
+    throttled = False
+
+    for attempt in range(MAX_ROUNDS):
+        if attempt:
+            if not throttled:
+                # Nothing was rate limited, so another pass would just repeat the same failures
+                break
+            # Every key/model failed or was benched — wait for the first key to come back
+            wait = max(0.0, min(limiter.cooldown_until for limiter in limiters) - time.monotonic())
+            print(f"    {label}: All keys busy, waiting {wait:.0f}s...", flush=True)
+            await asyncio.sleep(wait)
+
+        throttled = False
+        for model in MODELS:
+            for offset in range(num_keys):
+                ki = (key_index + offset) % num_keys
+                if limiters[ki].cooling_down():
+                    throttled = True
+                    continue
+                client = clients[ki]
+                try:
+                    await limiters[ki].wait()
+                    response = await client.aio.models.generate_content(model=model, contents=prompt, config=config)
+                    limiters[ki].succeeded()
+                    return parse_batch(response.text, len(emails)), ki
+                except BatchMismatchError:
+                    # Other keys/models won't do better; let the caller split the batch
+                    raise
+                except ValueError as e:
+                    # json.JSONDecodeError on a single-email request
+                    print(f"    {label}: Bad response on key{ki+1}/{model}: {e}", flush=True)
+                    continue
+                except Exception as e:
+                    err = str(e)
+                    if "429" in err or "503" in err:
+                        print(f"    {label}: Rate limited key{ki+1}/{model}", flush=True)
+                        limiters[ki].backoff()
+                        throttled = True
+                        continue
+                    raise
+
+    return None
+
+
+async def classify_email(
+    email: dict, clients: list, limiters: list[KeyLimiter], key_index: int
+) -> tuple[dict, int] | None:
+    """Classify a single email, rotating through keys and models on failure."""
+    result = await classify_batch([email], clients, limiters, key_index)
+    if result is None:
+        return None
+    data, ki = result
+    return data[0], ki
+
+
+async def classify_to_case(
+    email: dict, clients: list, limiters: list[KeyLimiter], key_index: int
+) -> tuple[dict, bool, int | None]:
+    """Classify one email into a case; returns (case, failed, index of the key that answered)."""
+    try:
+        result = await classify_email(email, clients, limiters, key_index)
+        if result is None:
+            raise RuntimeError("All keys exhausted")
+        data, ki = result
+        return build_case(email, data), False, ki
+    except Exception as e:
+        return error_case(email, e), True, None
+
+
+def build_case(email: dict, data: dict) -> dict:
+    return {
+        "email_id": email["id"],
+        "received_at": email["receivedAt"],
+        "from": email["from"],
+        "subject": email["subject"],
+        "body": email["body"],
+        **data,
+    }
+
+
+def error_case(email: dict, error: Exception) -> dict:
+    return build_case(email, {
+        "category": "Error",
+        "queue": "Manual Review",
+        "customer_name": "",
+        "invoice_references": [],
+        "amounts": [],
+        "dates": [],
+        "dispute_reason": "",
+        "next_action": f"Manual review needed: {str(error)[:100]}",
+    })
+
+
+def load_checkpoint() -> dict[str, dict]:
+    """Cases from a previous run, keyed by email id. Error cases are left out so they get retried."""
+    cases = []
+    if OUTPUT_FILE.exists():
+        with open(OUTPUT_FILE, "rb") as f:
+            cases.extend(orjson.loads(f.read()))
+    if PROGRESS_FILE.exists():
+        with open(PROGRESS_FILE, "rb") as f:
+            for line in f:
+                try:
+                    cases.append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    # Blank or half-written line from an interrupted run
+                    continue
+    return {c["email_id"]: c for c in cases if c.get("category") != "Error"}
 
-        # Save incrementally
-        OUTPUT_FILE.parent.mkdir(parents=True, exist_ok=True)
-        with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-            json.dump(results, f, indent=2)
 
-        # Rate limit delay
-        if i < len(emails) - 1:
-            time.sleep(4)
+def save_results(results: list[dict | None]):
+    with open(OUTPUT_FILE, "wb") as f:
+        f.write(orjson.dumps([r for r in results if r is not None], option=orjson.OPT_INDENT_2))
+
+
+async def main():
+    keys = get_api_keys()
+    if not keys:
+        print("Error: No GEMINI_API_KEY_* found in .env")
+        sys.exit(1)
+    print(f"Loaded {len(keys)} API keys.")
+
+    http = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
+    http_options = genai.types.HttpOptions(httpx_async_client=http, timeout=HTTP_TIMEOUT_MS)
+    clients = [genai.Client(api_key=k, http_options=http_options) for k in keys]
+    limiters = [KeyLimiter(RPM_PER_KEY) for _ in clients]
+
+    done = load_checkpoint()
+    if done:
+        print(f"Resuming: {len(done)} already processed")
+    print(f"Streaming emails from {DATA_FILE.name}...\n")
+
+    # Slots are reserved as emails are read so results keep input order
+    results: list[dict | None] = []
+
+    def todo() -> Iterator[tuple[int, dict]]:
+        """Yield (slot, email) for emails still to classify, filling in finished ones directly."""
+        for email in iter_emails():
+            if email["id"] in done:
+                results.append(done[email["id"]])
+                continue
+            results.append(None)
+            yield len(results) - 1, email
+
+    stats = {"done": 0, "errors": 0}
+
+    async def process_chunk(chunk: list[tuple[int, dict]], ki: int):
+        """Classify one batch, starting on key `ki`."""
+        batch = [email for _, email in chunk]
+        if len(batch) == 1:
+            outcomes = [await classify_to_case(batch[0], clients, limiters, ki)]
+        else:
+            try:
+                result = await classify_batch(batch, clients, limiters, ki)
+                if result is None:
+                    raise RuntimeError("All keys exhausted")
+                data, used = result
+                outcomes = [(build_case(email, d), False, used) for email, d in zip(batch, data)]
+            except BatchMismatchError as e:
+                # The reply was unusable; one request per email so a bad batch doesn't sink them all
+                print(f"    {batch[0]['id']}..{batch[-1]['id']}: {e}, classifying one at a time", flush=True)
+                outcomes = [await classify_to_case(email, clients, limiters, ki) for email in batch]
+            except Exception as e:
+                # Keys exhausted or a hard API error; splitting would only repeat it ten times.
+                # Error cases are retried on the next run.
+                outcomes = [(error_case(email, e), True, None) for email in batch]
+
+        for (i, email), (case, failed, used) in zip(chunk, outcomes):
+            results[i] = case
+            stats["done"] += 1
+            stats["errors"] += failed
+            if failed:
+                status = f"ERROR: {case['next_action']}"
+            else:
+                status = f"-> {case['category']} -> {case['queue']}"
+            key_note = f" (key {used+1})" if used is not None else ""
+            print(f"[{stats['done']}] {email['id']}{key_note} {status}", flush=True)
+            # Save incrementally
+            progress.write(orjson.dumps(case, option=orjson.OPT_APPEND_NEWLINE))
+        progress.flush()
+
+    pending = todo()
+
+    async def worker(ki: int):
+        """Pull batches off the shared stream, starting each one on key `ki`."""
+        # The stream never awaits, so workers can't interleave inside a single islice
+        while chunk := list(islice(pending, BATCH_SIZE)):
+            await process_chunk(chunk, ki)
+
+    OUTPUT_FILE.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(PROGRESS_FILE, "a+b") as progress:
+            # A crash can leave a half-written last line; start this run on a fresh one
+            if progress.tell():
+                progress.seek(-1, os.SEEK_END)
+                if progress.read(1) != b"\n":
+                    progress.write(b"\n")
+            await asyncio.gather(*(worker(ki) for ki in range(len(clients))))
+    finally:
+        await http.aclose()
+
+    save_results(results)
+    PROGRESS_FILE.unlink()
 
     # Print summary
-    counts = Counter(r["queue"] for r in results)
-    print(f"\nDone! Processed {len(results)}/{len(emails)} emails.")
+    counts = Counter(r["queue"] for r in results if r is not None)
+    print(f"\nDone! Processed {stats['done']} emails ({len(results) - stats['done']} from a previous run).")
     print(f"- Cash Application: {counts.get('Cash Application', 0)}")
     print(f"- Disputes: {counts.get('Disputes', 0)}")
     print(f"- AR Support: {counts.get('AR Support', 0)}")
-    if errors:
-        print(f"- Errors: {errors}")
+    if stats["errors"]:
+        print(f"- Errors: {stats['errors']}")
     print(f"Saved to {OUTPUT_FILE}")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,12 +1,20 @@
 """Draft email generator using Gemini API."""
 
-import json
+import functools
 import random
+from typing import TYPE_CHECKING
 
-from google import genai
+from parsing import parse_json
+
+if TYPE_CHECKING:
+    import httpx
+    from google import genai
 
 MODELS = ["gemini-2.5-flash-lite", "gemini-2.5-flash"]
 
+# In milliseconds. The SDK passes this on every request, overriding the httpx client's own timeout
+HTTP_TIMEOUT_MS = 60_000
+
 DRAFT_PROMPT = """You are a professional Accounts Receivable team member.
 Generate a response email for this case.
 
@@ -30,8 +38,31 @@ Respond with ONLY valid JSON, no markdown, no backticks:
 }}"""
 
 
-def generate_draft_email(case: dict, api_keys: list[str]) -> dict:
+# httpx and the Gemini SDK are imported inside these functions so the dashboard
+# doesn't load them until the first draft is requested
+
+
+@functools.lru_cache(maxsize=1)
+def _http_client() -> "httpx.Client":
+    """One connection pool shared by every key's client."""
+    import httpx
+
+    return httpx.Client(http2=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _client_for(key: str) -> "genai.Client":
+    """One client per key for the whole process so connections get reused."""
+    from google import genai
+
+    http_options = genai.types.HttpOptions(httpx_client=_http_client(), timeout=HTTP_TIMEOUT_MS)
+    return genai.Client(api_key=key, http_options=http_options)
+
+
+def generate_draft_email(case: dict, api_keys: tuple[str, ...]) -> dict:
     """Generate a draft response email for a case. Returns {subject, body}."""
+    from google import genai
+
     prompt = DRAFT_PROMPT.format(
         queue=case.get("queue", "AR Support"),
         category=case.get("category", ""),
@@ -45,7 +76,7 @@ def generate_draft_email(case: dict, api_keys: list[str]) -> dict:
     # Try random keys and models
     shuffled_keys = random.sample(api_keys, len(api_keys))
     for key in shuffled_keys:
-        client = genai.Client(api_key=key)
+        client = _client_for(key)
         for model in MODELS:
             try:
                 response = client.models.generate_content(
@@ -53,11 +84,7 @@ def generate_draft_email(case: dict, api_keys: list[str]) -> dict:
                     contents=prompt,
                     config=genai.types.GenerateContentConfig(max_output_tokens=1024),
                 )
-                text = response.text.strip()
-                if text.startswith("```"):
-                    text = text.split("\n", 1)[1]
-                    text = text.rsplit("```", 1)[0].strip()
-                return json.loads(text)
+                return parse_json(response.text)
             except Exception:
                 continue
 
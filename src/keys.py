@@ -0,0 +1,16 @@
+"""Gemini API key loading shared by the classifier and the dashboard."""
+
+import functools
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+@functools.lru_cache(maxsize=1)
+def get_api_keys() -> tuple[str, ...]:
+    """GEMINI_API_KEY_1..5 from .env, read once per process."""
+    load_dotenv(BASE_DIR / ".env")
+    return tuple(v for k in (f"GEMINI_API_KEY_{i}" for i in range(1, 6)) if (v := os.getenv(k)))
@@ -0,0 +1,12 @@
+"""Helpers for reading JSON out of Gemini responses."""
+
+import json
+import re
+
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*(.*?)\s*```\s*$", re.S)
+
+
+def parse_json(raw: str):
+    """Parse model output as JSON, unwrapping a markdown code fence if present."""
+    m = _FENCE_RE.match(raw)
+    return json.loads(m.group(1) if m else raw)